@@ -2,15 +2,73 @@
 # Distributed under the terms of the Modified BSD License.
 import logging
 import pathlib
-import time
+from collections.abc import Generator
+from typing import Any
 
+import docker
 import pytest  # type: ignore
 
 from tests.utils.tracked_container import TrackedContainer
 
 LOGGER = logging.getLogger(__name__)
 
+# Hard limit for every test in this module, so a hanging container doesn't stall the run.
+# It must stay above the longest `run_and_wait` timeout used below.
+pytestmark = pytest.mark.timeout(180)
 
+
+def exec_start_sh(container: TrackedContainer, cmd: str, **kwargs: Any) -> str:
+    """Runs `cmd` through `start.sh` in an already running container
+    and checks that there are no warnings and errors in the output."""
+    logs = container.exec_cmd(f"start.sh {cmd}", **kwargs)
+    assert not TrackedContainer.get_warnings(logs)
+    assert not TrackedContainer.get_errors(logs)
+    return logs
+
+
+# Files and directories `start.sh` changes when it is run with the
+# configurations checked in this module against the `long_lived_container`
+_RESET_ENV_COMMAND = (
+    "bash -c '"
+    "cp --preserve=all /tmp/passwd.orig /etc/passwd && "
+    "rm -rf /home/root"
+    "'"
+)
+
+
+@pytest.fixture(scope="module")
+def long_lived_container(
+    docker_client: docker.DockerClient, image_name: str
+) -> Generator[TrackedContainer]:
+    """Container started once for this module as root and kept running with
+    `sleep infinity`.
+
+    Tests run `start.sh` inside it using `exec_cmd` instead of launching a new
+    container for every check. Only use it for configurations that do not change
+    the user's UID/GID or the ownership of files in the image.
+    """
+    container = TrackedContainer(
+        docker_client,
+        image_name,
+    )
+    container.run_detached(user="root", command=["sleep", "infinity"])
+    logs = container.wait_for_log("Running as jovyan:", timeout=10)
+    assert not TrackedContainer.get_warnings(logs)
+    assert not TrackedContainer.get_errors(logs)
+    container.exec_cmd("cp --preserve=all /etc/passwd /tmp/passwd.orig", user="root")
+    yield container
+    container.remove()
+
+
+@pytest.fixture(scope="function")
+def reset_env(long_lived_container: TrackedContainer) -> Generator[None]:
+    """Reverts the changes `start.sh` made in the `long_lived_container`
+    when the caller is done with it."""
+    yield
+    long_lived_container.exec_cmd(_RESET_ENV_COMMAND, user="root")
+
+
+@pytest.mark.slow
 def test_uid_change(container: TrackedContainer) -> None:
     """Container should change the UID of the default user."""
     logs = container.run_and_wait(
@@ -34,6 +92,7 @@ def test_gid_change(container: TrackedContainer) -> None:
     assert "groups=110(jovyan),100(users)" in logs
 
 
+@pytest.mark.slow
 def test_nb_user_change(container: TrackedContainer) -> None:
     """Container should change the username (`NB_USER`) of the default user."""
     nb_user = "nayvoj"
@@ -43,43 +102,61 @@ def test_nb_user_change(container: TrackedContainer) -> None:
         command=["sleep", "infinity"],
     )
 
-    # Give the chown time to complete.
-    # Use sleep, not wait, because the container sleeps forever.
-    time.sleep(1)
+    # Wait for start.sh to finish, so the chown is complete.
+    # Don't use `wait`, because the container sleeps forever.
+    output = container.wait_for_log(f"Running as {nb_user}:", timeout=10)
     LOGGER.info(f"Checking if the user is changed to {nb_user} by the start script ...")
-    output = container.get_logs()
     assert "ERROR" not in output
     assert "WARNING" not in output
     assert (
         f"username: jovyan       -> {nb_user}" in output
     ), f"User is not changed to {nb_user}"
 
+    # Run all the checks in one exec to save the roundtrips to the docker daemon
+    command = (
+        "bash -c '"
+        "id && echo --- && "
+        f'stat -c "%U %G" /home/{nb_user}/ && echo --- && '
+        f'stat -c "%F %U %G" /home/{nb_user}/work'
+        "'"
+    )
+    output = container.exec_cmd(command, user=nb_user)
+    id_output, home_output, work_output = (part.strip() for part in output.split("---"))
+
     LOGGER.info(f"Checking {nb_user} id ...")
-    command = "id"
     expected_output = f"uid=1000({nb_user}) gid=100(users) groups=100(users)"
-    output = container.exec_cmd(command, user=nb_user, workdir=f"/home/{nb_user}")
-    assert output == expected_output, f"Bad user {output}, expected {expected_output}"
+    assert (
+        id_output == expected_output
+    ), f"Bad user {id_output}, expected {expected_output}"
 
     LOGGER.info(f"Checking if {nb_user} owns his home folder ...")
-    command = f'stat -c "%U %G" /home/{nb_user}/'
     expected_output = f"{nb_user} users"
-    output = container.exec_cmd(command, workdir=f"/home/{nb_user}")
     assert (
-        output == expected_output
-    ), f"Bad owner for the {nb_user} home folder {output}, expected {expected_output}"
+        home_output == expected_output
+    ), f"Bad owner for the {nb_user} home folder {home_output}, expected {expected_output}"
 
     LOGGER.info(
         f"Checking if a home folder of {nb_user} contains the 'work' folder with appropriate permissions ..."
     )
-    command = f'stat -c "%F %U %G" /home/{nb_user}/work'
     expected_output = f"directory {nb_user} users"
-    output = container.exec_cmd(command, workdir=f"/home/{nb_user}")
     assert (
-        output == expected_output
-    ), f"Folder work was not copied properly to {nb_user} home folder. stat: {output}, expected {expected_output}"
-
-
-def test_chown_extra(container: TrackedContainer) -> None:
+        work_output == expected_output
+    ), f"Folder work was not copied properly to {nb_user} home folder. stat: {work_output}, expected {expected_output}"
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize(
+    "chown_extra_opts,expected_root_owned",
+    [
+        ("-R", "1010:101"),
+        # `--from` makes chown skip the files which are not owned by the default user,
+        # so they are not copied up to the container layer
+        ("-R --from=1000:100", "0:0"),
+    ],
+)
+def test_chown_extra(
+    container: TrackedContainer, chown_extra_opts: str, expected_root_owned: str
+) -> None:
     """Container should change the UID/GID of a comma-separated
     CHOWN_EXTRA list of folders."""
     logs = container.run_and_wait(
@@ -88,8 +165,8 @@ def test_chown_extra(container: TrackedContainer) -> None:
         environment=[
             "NB_UID=1010",
             "NB_GID=101",
-            "CHOWN_EXTRA=/home/jovyan,/opt/conda/bin",
-            "CHOWN_EXTRA_OPTS=-R",
+            "CHOWN_EXTRA=/home/jovyan,/opt/conda/bin,/usr/local/bin",
+            f"CHOWN_EXTRA_OPTS={chown_extra_opts}",
         ],
         command=[
             "stat",
@@ -97,12 +174,16 @@ def test_chown_extra(container: TrackedContainer) -> None:
             "%n:%u:%g",
             "/home/jovyan/.bashrc",
             "/opt/conda/bin/jupyter",
+            "/usr/local/bin/start.sh",
         ],
     )
     assert "/home/jovyan/.bashrc:1010:101" in logs
     assert "/opt/conda/bin/jupyter:1010:101" in logs
+    # /usr/local/bin/start.sh is owned by root in the image
+    assert f"/usr/local/bin/start.sh:{expected_root_owned}" in logs
 
 
+@pytest.mark.slow
 def test_chown_home(container: TrackedContainer) -> None:
     """Container should change the NB_USER home directory owner and
     group to the current value of NB_UID and NB_GID."""
@@ -121,96 +202,108 @@ def test_chown_home(container: TrackedContainer) -> None:
     assert "/home/kitten/.bashrc:1010:101" in logs
 
 
-def test_sudo(container: TrackedContainer) -> None:
-    """Container should grant passwordless sudo to the default user."""
-    logs = container.run_and_wait(
-        timeout=10,
+@pytest.fixture(scope="module")
+def sudo_container(
+    docker_client: docker.DockerClient, image_name: str
+) -> Generator[TrackedContainer]:
+    """Container started with passwordless sudo granted to the default user."""
+    container = TrackedContainer(docker_client, image_name)
+    container.run_detached(
         user="root",
         environment=["GRANT_SUDO=yes"],
-        command=["sudo", "id"],
+        command=["sleep", "infinity"],
     )
-    assert "uid=0(root)" in logs
+    # sudo rights are granted by start.sh, make sure it has finished
+    logs = container.wait_for_log("Running as jovyan:", timeout=10)
+    assert not TrackedContainer.get_warnings(logs)
+    assert not TrackedContainer.get_errors(logs)
+    yield container
+    container.remove()
 
 
-def test_sudo_path(container: TrackedContainer) -> None:
-    """Container should include /opt/conda/bin in the sudo secure_path."""
-    logs = container.run_and_wait(
-        timeout=10,
-        user="root",
-        environment=["GRANT_SUDO=yes"],
-        command=["sudo", "which", "jupyter"],
-    )
-    assert logs.rstrip().endswith("/opt/conda/bin/jupyter")
+def test_sudo(sudo_container: TrackedContainer) -> None:
+    """Container should grant passwordless sudo to the default user."""
+    output = sudo_container.exec_cmd("sudo id", user="jovyan")
+    assert "uid=0(root)" in output
 
 
-def test_sudo_path_without_grant(container: TrackedContainer) -> None:
+def test_sudo_path(sudo_container: TrackedContainer) -> None:
     """Container should include /opt/conda/bin in the sudo secure_path."""
-    logs = container.run_and_wait(
-        timeout=10,
-        user="root",
-        command=["which", "jupyter"],
-    )
-    assert logs.rstrip().endswith("/opt/conda/bin/jupyter")
+    output = sudo_container.exec_cmd("sudo which jupyter", user="jovyan")
+    assert output.endswith("/opt/conda/bin/jupyter")
 
 
-def test_group_add(container: TrackedContainer) -> None:
-    """Container should run with the specified uid, gid, and secondary
-    group. It won't be possible to modify /etc/passwd since gid is nonzero, so
-    additionally verify that setting gid=0 is suggested in a warning.
-    """
-    logs = container.run_and_wait(
-        timeout=10,
-        no_warnings=False,
-        user="1010:1010",
-        group_add=["users"],  # Ensures write access to /home/jovyan
-        command=["id"],
-    )
-    warnings = TrackedContainer.get_warnings(logs)
-    assert len(warnings) == 1
-    assert "Try setting gid=0" in warnings[0]
-    assert "uid=1010 gid=1010 groups=1010,100(users)" in logs
-
-
-def test_set_uid(container: TrackedContainer) -> None:
-    """Container should run with the specified uid and NB_USER.
-    The /home/jovyan directory will not be writable since it's owned by 1000:users.
-    Additionally, verify that "--group-add=users" is suggested in a warning to restore
-    write access.
-    """
-    # This test needs to have tty disabled, the reason is explained here:
-    # https://github.com/jupyter/docker-stacks/pull/2260#discussion_r2008821257
-    logs = container.run_and_wait(
-        timeout=10, no_warnings=False, user="1010", command=["id"], tty=False
-    )
-    assert "uid=1010(jovyan) gid=0(root)" in logs
-    warnings = TrackedContainer.get_warnings(logs)
-    assert len(warnings) == 1
-    assert "--group-add=users" in warnings[0]
+@pytest.mark.usefixtures("reset_env")
+def test_sudo_path_without_grant(long_lived_container: TrackedContainer) -> None:
+    """Container should include /opt/conda/bin in the sudo secure_path."""
+    logs = exec_start_sh(long_lived_container, "which jupyter", user="root")
+    assert logs.rstrip().endswith("/opt/conda/bin/jupyter")
 
 
-def test_set_uid_and_nb_user(container: TrackedContainer) -> None:
-    """Container should run with the specified uid and NB_USER."""
+@pytest.mark.parametrize(
+    "user,group_add,environment,expected_id,expected_warning",
+    [
+        # It won't be possible to modify /etc/passwd since gid is nonzero,
+        # so setting gid=0 should be suggested in a warning
+        pytest.param(
+            "1010:1010",
+            ["users"],  # Ensures write access to /home/jovyan
+            [],
+            "uid=1010 gid=1010 groups=1010,100(users)",
+            "Try setting gid=0",
+            id="group_add",
+        ),
+        # The /home/jovyan directory will not be writable since it's owned by 1000:users,
+        # so "--group-add=users" should be suggested in a warning to restore write access
+        pytest.param(
+            "1010",
+            [],
+            [],
+            "uid=1010(jovyan) gid=0(root)",
+            "--group-add=users",
+            id="set_uid",
+        ),
+        pytest.param(
+            "1010",
+            ["users"],  # Ensures write access to /home/jovyan
+            ["NB_USER=kitten"],
+            "uid=1010(kitten) gid=0(root)",
+            "user is kitten but home is /home/jovyan",
+            id="set_uid_and_nb_user",
+        ),
+    ],
+)
+def test_set_uid_and_group(
+    container: TrackedContainer,
+    user: str,
+    group_add: list[str],
+    environment: list[str],
+    expected_id: str,
+    expected_warning: str,
+) -> None:
+    """Container should run with the specified uid, gid, secondary groups
+    and NB_USER, and warn about what can't be configured without root."""
     logs = container.run_and_wait(
         timeout=10,
         no_warnings=False,
-        user="1010",
-        environment=["NB_USER=kitten"],
-        group_add=["users"],  # Ensures write access to /home/jovyan
+        user=user,
+        group_add=group_add,
+        environment=environment,
         command=["id"],
     )
-    assert "uid=1010(kitten) gid=0(root)" in logs
+    assert expected_id in logs
     warnings = TrackedContainer.get_warnings(logs)
     assert len(warnings) == 1
-    assert "user is kitten but home is /home/jovyan" in warnings[0]
+    assert expected_warning in warnings[0]
 
 
 def test_container_not_delete_bind_mount(
-    container: TrackedContainer, tmp_path: pathlib.Path
+    container: TrackedContainer, fast_tmp_path: pathlib.Path
 ) -> None:
     """Container should not delete host system files when using the (docker)
     -v bind mount flag and mapping to /home/jovyan.
     """
-    host_data_dir = tmp_path / "data"
+    host_data_dir = fast_tmp_path / "data"
     host_data_dir.mkdir()
     host_file = host_data_dir / "foo.txt"
     host_file.write_text("some-content")
@@ -227,39 +320,35 @@ def test_container_not_delete_bind_mount(
         command=["ls"],
     )
     assert host_file.read_text() == "some-content"
-    assert len(list(tmp_path.iterdir())) == 1
+    assert len(list(fast_tmp_path.iterdir())) == 1
 
 
+@pytest.mark.usefixtures("reset_env")
 @pytest.mark.parametrize("enable_root", [False, True])
 def test_jupyter_env_vars_to_unset(
-    container: TrackedContainer, enable_root: bool
+    long_lived_container: TrackedContainer, enable_root: bool
 ) -> None:
     """Environment variables names listed in JUPYTER_ENV_VARS_TO_UNSET
     should be unset in the final environment."""
-    root_args = {"user": "root"} if enable_root else {}
-    logs = container.run_and_wait(
-        timeout=10,
+    logs = exec_start_sh(
+        long_lived_container,
+        "bash -c 'echo I like ${FRUIT} and ${SECRET_FRUIT:-stuff}, and love ${SECRET_ANIMAL:-to keep secrets}!'",
+        user="root" if enable_root else "jovyan",
         environment=[
             "JUPYTER_ENV_VARS_TO_UNSET=SECRET_ANIMAL,UNUSED_ENV,SECRET_FRUIT",
             "FRUIT=bananas",
             "SECRET_ANIMAL=cats",
             "SECRET_FRUIT=mango",
         ],
-        command=[
-            "bash",
-            "-c",
-            "echo I like ${FRUIT} and ${SECRET_FRUIT:-stuff}, and love ${SECRET_ANIMAL:-to keep secrets}!",
-        ],
-        **root_args,  # type: ignore
     )
     assert "I like bananas and stuff, and love to keep secrets!" in logs
 
 
-def test_secure_path(container: TrackedContainer, tmp_path: pathlib.Path) -> None:
+def test_secure_path(container: TrackedContainer, fast_tmp_path: pathlib.Path) -> None:
     """Make sure that the sudo command has conda's python (not system's) on PATH.
     See <https://github.com/jupyter/docker-stacks/issues/1053>.
     """
-    host_data_dir = tmp_path / "data"
+    host_data_dir = fast_tmp_path / "data"
     host_data_dir.mkdir()
     host_file = host_data_dir / "wrong_python.sh"
     host_file.write_text('#!/bin/bash\necho "Wrong python executable invoked!"')
@@ -293,40 +382,37 @@ def test_startsh_multiple_exec(container: TrackedContainer) -> None:
     )
 
 
-def test_rootless_triplet_change(container: TrackedContainer) -> None:
+@pytest.fixture(scope="module")
+def rootless_triplet_logs(long_lived_container: TrackedContainer) -> str:
+    """Output of `start.sh` for triplet NB_USER=root, NB_UID=0, NB_GID=0.
+    All the rootless triplet checks are run in a single exec."""
+    try:
+        return exec_start_sh(
+            long_lived_container,
+            "bash -c 'id && echo HOME=${HOME} && getent passwd root && env'",
+            user="root",
+            environment=["NB_USER=root", "NB_UID=0", "NB_GID=0"],
+        )
+    finally:
+        long_lived_container.exec_cmd(_RESET_ENV_COMMAND, user="root")
+
+
+def test_rootless_triplet_change(rootless_triplet_logs: str) -> None:
     """Container should change the username (`NB_USER`), the UID and the GID of the default user."""
-    logs = container.run_and_wait(
-        timeout=10,
-        user="root",
-        environment=["NB_USER=root", "NB_UID=0", "NB_GID=0"],
-        command=["id"],
-    )
-    assert "uid=0(root)" in logs
-    assert "gid=0(root)" in logs
-    assert "groups=0(root)" in logs
+    assert "uid=0(root)" in rootless_triplet_logs
+    assert "gid=0(root)" in rootless_triplet_logs
+    assert "groups=0(root)" in rootless_triplet_logs
 
 
-def test_rootless_triplet_home(container: TrackedContainer) -> None:
+def test_rootless_triplet_home(rootless_triplet_logs: str) -> None:
     """Container should change the home directory for triplet NB_USER=root, NB_UID=0, NB_GID=0."""
-    logs = container.run_and_wait(
-        timeout=10,
-        user="root",
-        environment=["NB_USER=root", "NB_UID=0", "NB_GID=0"],
-        command=["bash", "-c", "echo HOME=${HOME} && getent passwd root"],
-    )
-    assert "HOME=/home/root" in logs
-    assert "root:x:0:0:root:/home/root:/bin/bash" in logs
+    assert "HOME=/home/root" in rootless_triplet_logs
+    assert "root:x:0:0:root:/home/root:/bin/bash" in rootless_triplet_logs
 
 
-def test_rootless_triplet_sudo(container: TrackedContainer) -> None:
+def test_rootless_triplet_sudo(rootless_triplet_logs: str) -> None:
     """Container should not be started with sudo for triplet NB_USER=root, NB_UID=0, NB_GID=0."""
-    logs = container.run_and_wait(
-        timeout=10,
-        user="root",
-        environment=["NB_USER=root", "NB_UID=0", "NB_GID=0"],
-        command=["env"],
-    )
-    assert "SUDO" not in logs
+    assert "SUDO" not in rootless_triplet_logs
 
 
 def test_log_stderr(container: TrackedContainer) -> None:
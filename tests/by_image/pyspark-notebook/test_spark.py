@@ -12,6 +12,7 @@ def test_spark_shell(container: TrackedContainer) -> None:
     logs = container.run_and_wait(
         timeout=60,
         no_warnings=False,
+        tty=True,  # spark-shell is an interactive REPL
         command=["bash", "-c", 'spark-shell <<< "1+1"'],
     )
     warnings = TrackedContainer.get_warnings(logs)
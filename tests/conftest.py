@@ -2,9 +2,12 @@
 # Distributed under the terms of the Modified BSD License.
 import logging
 import os
+import shutil
 import socket
+import uuid
 from collections.abc import Generator
 from contextlib import closing
+from pathlib import Path
 
 import docker
 import pytest  # type: ignore
@@ -17,6 +20,25 @@ from tests.utils.tracked_container import TrackedContainer
 LOGGER = logging.getLogger(__name__)
 
 
+def pytest_sessionstart(session: pytest.Session) -> None:
+    """Pulls the image to test if it's missing, before any test is run.
+
+    With pytest-xdist, this is done only once by the controller process,
+    before the workers are started.
+    """
+    if hasattr(session.config, "workerinput") or session.config.option.collectonly:
+        return
+    image_name = os.environ["TEST_IMAGE"]
+    client = docker.from_env()
+    try:
+        client.images.get(image_name)
+    except docker.errors.ImageNotFound:
+        LOGGER.info(f"Pulling image: {image_name} ...")
+        client.images.pull(image_name)
+    finally:
+        client.close()
+
+
 @pytest.fixture(scope="session")
 def http_client() -> requests.Session:
     """Requests session with retries and backoff."""
@@ -65,3 +87,20 @@ def free_host_port() -> Generator[int]:
         s.bind(("", 0))
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         yield s.getsockname()[1]
+
+
+@pytest.fixture(scope="function")
+def fast_tmp_path(tmp_path_factory: pytest.TempPathFactory) -> Generator[Path]:
+    """Temporary directory for files bind-mounted to containers.
+
+    It's created in memory (/dev/shm) when possible to avoid slow disk I/O.
+    /dev/shm is not used when it's mounted with `noexec`, as bind mounts keep this flag
+    and tests may need to run the files they mount.
+    """
+    shm_dir = Path("/dev/shm")
+    use_shm = shm_dir.is_dir() and not os.statvfs(shm_dir).f_flag & os.ST_NOEXEC
+    root = shm_dir if use_shm else tmp_path_factory.mktemp("fast_tmp")
+    path = root / f"test-{uuid.uuid4().hex}"
+    path.mkdir()
+    yield path
+    shutil.rmtree(path)
@@ -1,6 +1,7 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 import logging
+import threading
 from typing import Any, Literal, LiteralString, overload
 
 import docker
@@ -60,6 +61,48 @@ class TrackedContainer:
         assert isinstance(logs, str)
         return logs
 
+    def wait_for_log(self, needle: str, timeout: float) -> str:
+        """Streams the container logs until `needle` appears in them.
+
+        Parameters
+        ----------
+        needle: str
+            Text to wait for
+        timeout: float
+            Number of seconds to wait for `needle` before failing
+
+        Returns
+        -------
+        str
+            Logs received until `needle` was found
+        """
+        assert self.container is not None
+        LOGGER.info(f"Waiting for `{needle}` in container {self.container.name} logs")
+        encoded_needle = needle.encode()
+        stream = self.container.logs(stream=True, follow=True)
+        # The stream blocks while the container is silent, so close it on timeout
+        timer = threading.Timer(timeout, stream.close)
+        timer.start()
+        # Logs of tty containers are streamed byte by byte, so append in place
+        logs = bytearray()
+        found = False
+        try:
+            for chunk in stream:
+                # Only the new chunk (and the end of the previous one) has to be searched
+                search_start = max(0, len(logs) - len(encoded_needle) + 1)
+                logs += chunk
+                if logs.find(encoded_needle, search_start) != -1:
+                    found = True
+                    break
+        finally:
+            timer.cancel()
+            stream.close()
+        output = logs.decode()
+        if not found:
+            LOGGER.error(f"Container logs:\n{output}")
+            raise AssertionError(f"`{needle}` not found in logs (timeout: {timeout}s)")
+        return output
+
     def get_health(self) -> str:
         assert self.container is not None
         self.container.reload()
@@ -90,6 +133,7 @@ class TrackedContainer:
         no_warnings: bool = True,
         no_errors: bool = True,
         no_failure: bool = True,
+        tty: bool = False,
         split_stderr: Literal[True],
         **kwargs: Any,
     ) -> tuple[str, str]: ...
@@ -102,6 +146,7 @@ class TrackedContainer:
         no_warnings: bool = True,
         no_errors: bool = True,
         no_failure: bool = True,
+        tty: bool = False,
         split_stderr: Literal[False] = False,
         **kwargs: Any,
     ) -> str: ...
@@ -113,13 +158,13 @@ class TrackedContainer:
         no_warnings: bool = True,
         no_errors: bool = True,
         no_failure: bool = True,
+        tty: bool = False,
         split_stderr: bool = False,
         **kwargs: Any,
     ) -> str | tuple[str, str]:
         if split_stderr:
-            kwargs.setdefault("tty", False)
-            assert kwargs["tty"] is False, "split_stderr only works with tty=False"
-        self.run_detached(**kwargs)
+            assert not tty, "split_stderr only works with tty=False"
+        self.run_detached(tty=tty, **kwargs)
         assert self.container is not None
         rv = self.container.wait(timeout=timeout)
         stdout: str